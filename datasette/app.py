@@ -2,9 +2,9 @@ import asyncio
 import click
 import collections
 import hashlib
+import logging
 import os
 import sys
-import threading
 import traceback
 import urllib.parse
 from concurrent import futures
@@ -25,23 +25,41 @@ from .views.special import JsonDataView
 from .views.table import RowView, TableView
 
 from .utils import (
+    ConnectionPool,
     InterruptedError,
+    LRUCache,
     Results,
+    decode_utf8_replace,
     escape_css_string,
     escape_sqlite,
     get_plugins,
+    is_utf8_decode_error,
     module_from_path,
     sqlite3,
     sqlite_timelimit,
     to_css_class
 )
-from .inspect import inspect_hash, inspect_views, inspect_tables
+from .inspect import (
+    inspect_count,
+    inspect_estimated_counts,
+    inspect_hash,
+    inspect_schema_version,
+    inspect_sqlite_master,
+    inspect_tables,
+    inspect_views
+)
 from .plugins import pm, DEFAULT_PLUGINS
 from .version import __version__
 
 app_root = Path(__file__).parent.parent
 
-connections = threading.local()
+logger = logging.getLogger(__name__)
+
+FOREIGN_KEY_LABEL_CACHE_SIZE = 1024
+
+# On-demand table counts are a full table scan and are repeated for every
+# table on the index page, so give up on them sooner than regular queries
+TABLE_COUNT_TIME_LIMIT_MS = 50
 
 
 ConfigOption = collections.namedtuple(
@@ -87,6 +105,9 @@ CONFIG_OPTIONS = (
     ConfigOption("cache_size_kb", 0, """
         SQLite cache size in KB (0 == use SQLite default)
     """.strip()),
+    ConfigOption("mmap_size_mb", 256, """
+        SQLite memory-mapped I/O size in MB (0 == disable memory-mapped I/O)
+    """.strip()),
     ConfigOption("allow_csv_stream", True, """
         Allow .csv?_stream=1 to download all rows (ignoring max_returned_rows)
     """.strip()),
@@ -129,7 +150,16 @@ class Datasette:
         self.files = files
         self.cache_headers = cache_headers
         self.cors = cors
-        self._inspect = inspect_data
+        self._inspect = None
+        self._inspect_counts = False
+        self._inspect_data = inspect_data
+        self._table_counts = {}
+        self._estimated_counts = {}
+        self._connection_pools = {}
+        self._definitions = {}
+        self._versions = None
+        # Maps (database, table, column, label_column, value) -> label
+        self.foreign_key_label_cache = LRUCache(FOREIGN_KEY_LABEL_CACHE_SIZE)
         self._metadata = metadata or {}
         self.sqlite_functions = []
         self.sqlite_extensions = sqlite_extensions or []
@@ -243,20 +273,35 @@ class Datasette:
             return query
 
     async def get_table_definition(self, database_name, table, type_="table"):
-        table_definition_rows = list(
-            await self.execute(
-                database_name,
-                'select sql from sqlite_master where name = :n and type=:t',
-                {"n": table, "t": type_},
-            )
-        )
-        if not table_definition_rows:
+        definition_type, sql = await self.get_definition(database_name, table)
+        if definition_type != type_:
             return None
-        return table_definition_rows[0][0]
+        return sql
 
     def get_view_definition(self, database_name, view):
         return self.get_table_definition(database_name, view, 'view')
 
+    async def get_definition(self, database_name, name):
+        "Returns (type, sql) for a table or view, or (None, None) if missing"
+        info = self.inspect()[database_name]
+        if name not in info["tables"] and name not in info["views"]:
+            return None, None
+        # The databases are immutable, so definitions can be cached
+        key = (database_name, name)
+        if key not in self._definitions:
+            rows = (
+                await self.execute(
+                    database_name,
+                    "select type, sql from sqlite_master "
+                    "where name = :n and type in ('table', 'view')",
+                    {"n": name},
+                )
+            ).rows
+            if not rows:
+                return None, None
+            self._definitions[key] = (rows[0][0], rows[0][1])
+        return self._definitions[key]
+
     def update_with_inherited_metadata(self, metadata):
         # Fills in source/license with defaults, if available
         metadata.update(
@@ -271,53 +316,176 @@ class Datasette:
         )
 
     def prepare_connection(self, conn):
-        conn.row_factory = sqlite3.Row
-        conn.text_factory = lambda x: str(x, "utf-8", "replace")
+        # str is decoded in C - databases containing invalid UTF-8 switch to
+        # decode_utf8_replace the first time a query trips over it
+        conn.text_factory = str
         for name, num_args, func in self.sqlite_functions:
             conn.create_function(name, num_args, func)
         if self.sqlite_extensions:
             conn.enable_load_extension(True)
             for extension in self.sqlite_extensions:
-                conn.execute("SELECT load_extension('{}')".format(extension))
+                conn.load_extension(extension)
+            # Stop ?sql= queries from calling load_extension() themselves
+            conn.enable_load_extension(False)
         if self.config("cache_size_kb"):
             conn.execute('PRAGMA cache_size=-{}'.format(self.config("cache_size_kb")))
+        if self.config("mmap_size_mb"):
+            conn.execute('PRAGMA mmap_size={}'.format(
+                int(self.config("mmap_size_mb")) * 1024 * 1024
+            ))
         pm.hook.prepare_connection(conn=conn)
 
+    def get_table_info(self, database_name, table):
+        "Returns the inspect() data for a single table, or {} if missing"
+        return self.inspect()[database_name]["tables"].get(table) or {}
+
     def table_exists(self, database, table):
         return table in self.inspect().get(database, {}).get("tables")
 
-    def inspect(self):
-        " Inspect the database and return a dictionary of table metadata "
-        if self._inspect:
+    def inspect(self, counts=False):
+        """ Inspect the database and return a dictionary of table metadata
+
+            Table row counts are only calculated if counts=True, otherwise
+            use table_count() / table_counts() to fetch them on demand.
+            Cached data without counts is recalculated if counts=True.
+        """
+        if self._inspect and (self._inspect_counts or not counts):
             return self._inspect
 
         self._inspect = {}
+        self._inspect_counts = counts
+        if self._inspect_data:
+            # Reuse data from `datasette inspect` for any database whose
+            # schema has not changed since it was generated
+            for name, info in self._inspect_data.items():
+                path = Path(info["file"])
+                if path.exists() and info.get("schema_version") != (
+                    self._schema_version(path)
+                ):
+                    info = self.inspect_database(name, path, counts)
+                self._inspect[name] = info
+            return self._inspect
+
         for filename in self.files:
             path = Path(filename)
             name = path.stem
             if name in self._inspect:
                 raise Exception("Multiple files with same stem %s" % name)
+            self._inspect[name] = self.inspect_database(name, path, counts)
+        return self._inspect
+
+    def _schema_version(self, path):
+        conn = sqlite3.connect("file:{}?immutable=1".format(path), uri=True)
+        try:
+            return inspect_schema_version(conn)
+        finally:
+            conn.close()
+
+    def inspect_database(self, name, path, counts=False):
+        " Inspect a single database file, see inspect() "
+        try:
+            with sqlite3.connect(
+                "file:{}?immutable=1".format(path), uri=True
+            ) as conn:
+                self.prepare_connection(conn)
+                # Schema text is small, so decode it leniently up front
+                # rather than using the str fast path and retrying
+                conn.text_factory = decode_utf8_replace
+                sqlite_master = inspect_sqlite_master(conn)
+                return {
+                    "hash": inspect_hash(path),
+                    "file": str(path),
+                    "schema_version": inspect_schema_version(conn),
+                    "views": inspect_views(sqlite_master),
+                    "tables": inspect_tables(
+                        conn,
+                        (self.metadata("databases") or {}).get(name, {}),
+                        sqlite_master,
+                        counts=counts,
+                    ),
+                }
+        except sqlite3.OperationalError as e:
+            if (e.args[0] == 'no such module: VirtualSpatialIndex'):
+                raise click.UsageError(
+                    "It looks like you're trying to load a SpatiaLite"
+                    " database without first loading the SpatiaLite module."
+                    "\n\nRead more: https://datasette.readthedocs.io/en/latest/spatialite.html"
+                )
+            else:
+                raise
+
+    async def table_count(self, database_name, table):
+        """ Row count for a table, calculated on demand and cached.
+
+            Returns None if counting the rows exceeded the time limit - that
+            result is cached too, so the table is not scanned again.
+        """
+        count = self.get_table_info(database_name, table)["count"]
+        if count is not None:
+            # Pre-calculated by `datasette inspect`
+            return count
+        key = (database_name, table)
+        if key not in self._table_counts:
+            time_limit_ms = min(TABLE_COUNT_TIME_LIMIT_MS, self.sql_time_limit_ms)
+
+            def count_in_thread(conn):
+                with sqlite_timelimit(conn, time_limit_ms):
+                    return inspect_count(conn, table)
+
             try:
-                with sqlite3.connect(
-                    "file:{}?immutable=1".format(path), uri=True
-                ) as conn:
-                    self.prepare_connection(conn)
-                    self._inspect[name] = {
-                        "hash": inspect_hash(path),
-                        "file": str(path),
-                        "views": inspect_views(conn),
-                        "tables": inspect_tables(conn, (self.metadata("databases") or {}).get(name, {}))
-                    }
-            except sqlite3.OperationalError as e:
-                if (e.args[0] == 'no such module: VirtualSpatialIndex'):
-                    raise click.UsageError(
-                        "It looks like you're trying to load a SpatiaLite"
-                        " database without first loading the SpatiaLite module."
-                        "\n\nRead more: https://datasette.readthedocs.io/en/latest/spatialite.html"
+                self._table_counts[key] = await self.execute_against_connection_in_thread(
+                    database_name, count_in_thread
+                )
+            except InterruptedError:
+                self._table_counts[key] = None
+        return self._table_counts[key]
+
+    async def estimated_table_counts(self, database_name):
+        """ Row counts estimated by ANALYZE, from sqlite_stat1 - cached
+
+            Returns a dictionary mapping table name to estimated count,
+            only for tables that have been analyzed.
+        """
+        if database_name not in self._estimated_counts:
+            time_limit_ms = min(TABLE_COUNT_TIME_LIMIT_MS, self.sql_time_limit_ms)
+
+            def estimate_in_thread(conn):
+                with sqlite_timelimit(conn, time_limit_ms):
+                    return inspect_estimated_counts(conn)
+
+            try:
+                self._estimated_counts[database_name] = (
+                    await self.execute_against_connection_in_thread(
+                        database_name, estimate_in_thread
                     )
-                else:
-                    raise
-        return self._inspect
+                )
+            except InterruptedError:
+                # Not cached, so the estimates are read again next time
+                return {}
+        return self._estimated_counts[database_name]
+
+    async def table_counts(self, database_name, use_estimated_count=False):
+        """ Row counts for every table in a database, see table_count()
+
+            use_estimated_count=True uses the estimated_table_counts() from
+            ANALYZE for tables with no known exact count, avoiding full
+            table scans.
+        """
+        tables = self.inspect()[database_name]["tables"]
+        estimated_counts = {}
+        if use_estimated_count:
+            estimated_counts = await self.estimated_table_counts(database_name)
+        counts = {}
+        for table in tables:
+            if (
+                table in estimated_counts
+                and tables[table]["count"] is None
+                and self._table_counts.get((database_name, table)) is None
+            ):
+                counts[table] = estimated_counts[table]
+            else:
+                counts[table] = await self.table_count(database_name, table)
+        return counts
 
     def register_custom_units(self):
         "Register any custom units defined in the metadata.json with Pint"
@@ -325,8 +493,16 @@ class Datasette:
             ureg.define(unit)
 
     def versions(self):
+        # Detecting versions opens a connection and runs prepare_connection,
+        # which loads extensions and plugin hooks - so only do that once
+        if self._versions is None:
+            self._versions = self._detect_versions()
+        return self._versions
+
+    def _detect_versions(self):
         conn = sqlite3.connect(":memory:")
         self.prepare_connection(conn)
+        conn.text_factory = decode_utf8_replace
         sqlite_version = conn.execute("select sqlite_version()").fetchone()[0]
         sqlite_extensions = {}
         for extension, testsql, hasversion in (
@@ -351,6 +527,7 @@ class Datasette:
                 fts_versions.append(fts)
             except sqlite3.OperationalError:
                 continue
+        conn.close()
         datasette_version = {"version": __version__}
         if self.version_note:
             datasette_version["note"] = self.version_note
@@ -377,6 +554,46 @@ class Datasette:
             for p in get_plugins(pm) if p["name"] not in DEFAULT_PLUGINS
         ]
 
+    def connection_pool(self, db_name):
+        "Pool of read-only connections to db_name, one per SQL thread"
+        if db_name not in self._connection_pools:
+            info = self.inspect()[db_name]
+
+            def connect():
+                conn = sqlite3.connect(
+                    "file:{}?immutable=1".format(info["file"]),
+                    uri=True,
+                    check_same_thread=False,
+                )
+                # Views access query results by column name as well as index
+                conn.row_factory = sqlite3.Row
+                self.prepare_connection(conn)
+                return conn
+
+            self._connection_pools[db_name] = ConnectionPool(
+                connect, max_size=self.config("num_sql_threads")
+            )
+        return self._connection_pools[db_name]
+
+    async def execute_against_connection_in_thread(self, db_name, fn):
+        "Calls fn(conn) in a thread, using a pooled connection to db_name"
+        pool = self.connection_pool(db_name)
+
+        def in_thread():
+            with pool.connection() as conn:
+                try:
+                    return fn(conn)
+                except sqlite3.OperationalError as e:
+                    if conn.text_factory is not str or not is_utf8_decode_error(e):
+                        raise
+                # Invalid UTF-8: decode leniently on this connection from now on
+                conn.text_factory = decode_utf8_replace
+                return fn(conn)
+
+        return await asyncio.get_event_loop().run_in_executor(
+            self.executor, in_thread
+        )
+
     async def execute(
         self,
         db_name,
@@ -389,18 +606,7 @@ class Datasette:
         """Executes sql against db_name in a thread"""
         page_size = page_size or self.page_size
 
-        def sql_operation_in_thread():
-            conn = getattr(connections, db_name, None)
-            if not conn:
-                info = self.inspect()[db_name]
-                conn = sqlite3.connect(
-                    "file:{}?immutable=1".format(info["file"]),
-                    uri=True,
-                    check_same_thread=False,
-                )
-                self.prepare_connection(conn)
-                setattr(connections, db_name, conn)
-
+        def sql_operation_in_thread(conn):
             time_limit_ms = self.sql_time_limit_ms
             if custom_time_limit and custom_time_limit < time_limit_ms:
                 time_limit_ms = custom_time_limit
@@ -415,17 +621,19 @@ class Datasette:
                     if max_returned_rows and truncate:
                         rows = cursor.fetchmany(max_returned_rows + 1)
                         truncated = len(rows) > max_returned_rows
-                        rows = rows[:max_returned_rows]
+                        if truncated:
+                            rows.pop()
                     else:
                         rows = cursor.fetchall()
                         truncated = False
                 except sqlite3.OperationalError as e:
                     if e.args == ('interrupted',):
                         raise InterruptedError(e)
-                    print(
-                        "ERROR: conn={}, sql = {}, params = {}: {}".format(
-                            conn, repr(sql), params, e
-                        )
+                    if is_utf8_decode_error(e):
+                        # execute_against_connection_in_thread() retries this
+                        raise
+                    logger.error(
+                        "conn=%s, sql = %r, params = %s: %s", conn, sql, params, e
                     )
                     raise
 
@@ -435,8 +643,36 @@ class Datasette:
             else:
                 return Results(rows, False, cursor.description)
 
-        return await asyncio.get_event_loop().run_in_executor(
-            self.executor, sql_operation_in_thread
+        return await self.execute_against_connection_in_thread(
+            db_name, sql_operation_in_thread
+        )
+
+    async def execute_many(self, db_name, queries, custom_time_limit=None):
+        """Executes a list of (sql, params) against db_name in one thread,
+        returning the rows from all of them"""
+        time_limit_ms = self.sql_time_limit_ms
+        if custom_time_limit and custom_time_limit < time_limit_ms:
+            time_limit_ms = custom_time_limit
+
+        def sql_operations_in_thread(conn):
+            rows = []
+            with sqlite_timelimit(conn, time_limit_ms):
+                for sql, params in queries:
+                    try:
+                        rows.extend(conn.execute(sql, params or {}).fetchall())
+                    except sqlite3.OperationalError as e:
+                        if e.args == ('interrupted',):
+                            raise InterruptedError(e)
+                        if not is_utf8_decode_error(e):
+                            logger.error(
+                                "conn=%s, sql = %r, params = %s: %s",
+                                conn, sql, params, e
+                            )
+                        raise
+            return rows
+
+        return await self.execute_against_connection_in_thread(
+            db_name, sql_operations_in_thread
         )
 
     def app(self):
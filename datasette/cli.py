@@ -75,7 +75,7 @@ def cli():
 )
 def inspect(files, inspect_file, sqlite_extensions):
     app = Datasette(files, sqlite_extensions=sqlite_extensions)
-    open(inspect_file, "w").write(json.dumps(app.inspect(), indent=2))
+    open(inspect_file, "w").write(json.dumps(app.inspect(counts=True), indent=2))
 
 
 @cli.group()
@@ -370,6 +370,6 @@ def serve(
         config=dict(config),
         version_note=version_note,
     )
-    # Force initial hashing/table counting
+    # Force initial hashing/table introspection - row counts are on demand
     ds.inspect()
     ds.app().run(host=host, port=port, debug=debug)
@@ -1,7 +1,10 @@
 import hashlib
+import itertools
+import re
 
 from .utils import (
-    detect_spatialite,
+    SQLITE_TABLE_VALUED_PRAGMAS,
+    InterruptedError,
     detect_fts,
     escape_sqlite,
     get_all_foreign_keys,
@@ -11,6 +14,9 @@ from .utils import (
 
 HASH_BLOCK_SIZE = 1024 * 1024
 
+# Equivalent of: sql like '%VIRTUAL TABLE%USING FTS%'
+FTS_VIRTUAL_TABLE_RE = re.compile(r"VIRTUAL TABLE.*USING FTS", re.I | re.S)
+
 
 def inspect_hash(path):
     " Calculate the hash of a database, efficiently. "
@@ -25,9 +31,30 @@ def inspect_hash(path):
     return m.hexdigest()
 
 
-def inspect_views(conn):
+def inspect_schema_version(conn):
+    """ SQLite's schema cookie, incremented every time the schema changes.
+
+        This is a constant-time check, so it is used to tell if cached
+        inspect data is still valid for a database.
+    """
+    return conn.execute("PRAGMA schema_version").fetchone()[0]
+
+
+def inspect_sqlite_master(conn):
+    """ Fetch (name, type, rootpage, sql) for every table and view at once.
+
+        The inspect_* functions classify these rows in Python rather than
+        each running their own query against sqlite_master.
+    """
+    return conn.execute(
+        "select name, type, rootpage, sql from sqlite_master "
+        "where type in ('table', 'view')"
+    ).fetchall()
+
+
+def inspect_views(sqlite_master):
     " List views in a database. "
-    return [v[0] for v in conn.execute('select name from sqlite_master where type = "view"')]
+    return [r[0] for r in sqlite_master if r[1] == "view"]
 
 
 def detect_label_column(column_names):
@@ -41,54 +68,109 @@ def detect_label_column(column_names):
     return None
 
 
-def detect_primary_keys(conn, table):
-    " Figure out primary keys for a table. "
-    table_info_rows = [
-        row
-        for row in conn.execute(
-            'PRAGMA table_info("{}")'.format(table)
-        ).fetchall()
-        if row[-1]
-    ]
-    table_info_rows.sort(key=lambda row: row[-1])
-    return [str(r[1]) for r in table_info_rows]
+def inspect_columns(conn):
+    """ Figure out the columns and primary keys for every table at once.
 
-
-def inspect_tables(conn, database_metadata):
-    " List tables and their row counts, excluding uninteresting tables. "
+        Returns a dictionary mapping table name to (column_names, primary_keys).
+    """
+    if SQLITE_TABLE_VALUED_PRAGMAS:
+        rows = conn.execute(
+            """
+                select m.name, p.name, p.pk
+                from sqlite_master m join pragma_table_info(m.name) p
+                where m.type = 'table'
+                order by m.name, p.cid
+            """
+        ).fetchall()
+    else:
+        # Older SQLite: one PRAGMA table_info per table
+        rows = []
+        table_names = conn.execute(
+            "select name from sqlite_master where type = 'table' order by name"
+        ).fetchall()
+        for (table,) in table_names:
+            rows.extend(
+                (table, r[1], r[5])
+                for r in conn.execute(
+                    'PRAGMA table_info("{}")'.format(table.replace('"', '""'))
+                ).fetchall()
+            )
+    columns = {}
+    for table, table_rows in itertools.groupby(rows, key=lambda r: r[0]):
+        table_rows = list(table_rows)
+        column_names = [r[1] for r in table_rows]
+        primary_keys = [str(r[1]) for r in sorted(
+            (r for r in table_rows if r[2]), key=lambda r: r[2]
+        )]
+        columns[table] = (column_names, primary_keys)
+    return columns
+
+
+def inspect_count(conn, table):
+    " Count the rows in a table - this is a full table scan. "
+    try:
+        return conn.execute(
+            "select count(*) from {}".format(escape_sqlite(table))
+        ).fetchone()[0]
+    except sqlite3.OperationalError as e:
+        if e.args == ('interrupted',):
+            raise InterruptedError(e)
+        # This can happen when running against a FTS virtual table
+        # e.g. "select count(*) from some_fts;"
+        return 0
+
+
+def inspect_estimated_counts(conn):
+    """ Estimated row counts for tables that have been ANALYZEd.
+
+        sqlite_stat1 has a row for each index, and the first token of its
+        stat is the number of rows in that index. A partial index covers
+        fewer rows than its table, so use the largest value for each table.
+    """
+    try:
+        rows = conn.execute("select tbl, stat from sqlite_stat1").fetchall()
+    except sqlite3.OperationalError as e:
+        if e.args == ('interrupted',):
+            raise InterruptedError(e)
+        if not e.args[0].startswith("no such table"):
+            raise
+        # No sqlite_stat1 table, ANALYZE has never been run
+        return {}
+    counts = {}
+    for tbl, stat in rows:
+        first = stat.split()[0] if stat else ""
+        if first.isdigit():
+            counts[tbl] = max(counts.get(tbl, 0), int(first))
+    return counts
+
+
+def inspect_tables(conn, database_metadata, sqlite_master, counts=False):
+    """ List tables, excluding uninteresting tables.
+
+        sqlite_master is the result of inspect_sqlite_master(conn).
+
+        Row counts require a full table scan so are only calculated if
+        counts=True - otherwise count is None and can be fetched on demand.
+    """
     tables = {}
-    table_names = [
-        r["name"]
-        for r in conn.execute(
-            'select * from sqlite_master where type="table"'
-        )
-    ]
+    table_names = [r[0] for r in sqlite_master if r[1] == "table"]
+    table_columns = inspect_columns(conn)
 
     for table in table_names:
         table_metadata = database_metadata.get("tables", {}).get(
             table, {}
         )
 
-        try:
-            count = conn.execute(
-                "select count(*) from {}".format(escape_sqlite(table))
-            ).fetchone()[0]
-        except sqlite3.OperationalError:
-            # This can happen when running against a FTS virtual table
-            # e.g. "select count(*) from some_fts;"
-            count = 0
-
-        column_names = [
-            r[1]
-            for r in conn.execute(
-                "PRAGMA table_info({});".format(escape_sqlite(table))
-            ).fetchall()
-        ]
+        count = None
+        if counts:
+            count = inspect_count(conn, table)
+
+        column_names, primary_keys = table_columns.get(table, ([], []))
 
         tables[table] = {
             "name": table,
             "columns": column_names,
-            "primary_keys": detect_primary_keys(conn, table),
+            "primary_keys": primary_keys,
             "count": count,
             "label_column": detect_label_column(column_names),
             "hidden": table_metadata.get("hidden") or False,
@@ -101,17 +183,12 @@ def inspect_tables(conn, database_metadata):
 
     # Mark tables 'hidden' if they relate to FTS virtual tables
     hidden_tables = [
-        r["name"]
-        for r in conn.execute(
-            """
-                select name from sqlite_master
-                where rootpage = 0
-                and sql like '%VIRTUAL TABLE%USING FTS%'
-            """
-        )
+        name
+        for name, type_, rootpage, sql in sqlite_master
+        if rootpage == 0 and sql and FTS_VIRTUAL_TABLE_RE.search(sql)
     ]
 
-    if detect_spatialite(conn):
+    if "geometry_columns" in table_names:
         # Also hide Spatialite internal tables
         hidden_tables += [
             "ElementaryGeometries",
@@ -124,20 +201,14 @@ def inspect_tables(conn, database_metadata):
             "views_geometry_columns",
             "virts_geometry_columns",
         ] + [
-            r["name"]
-            for r in conn.execute(
-                """
-                    select name from sqlite_master
-                    where name like "idx_%"
-                    and type = "table"
-                """
-            )
+            name for name in table_names if name.startswith("idx_")
         ]
 
+    # startswith() with a tuple checks every prefix in a single call - this
+    # covers exact matches too, e.g. the FTS table itself
+    hidden_prefixes = tuple(hidden_tables)
     for t in tables.keys():
-        for hidden_table in hidden_tables:
-            if t == hidden_table or t.startswith(hidden_table):
-                tables[t]["hidden"] = True
-                continue
+        if t.startswith(hidden_prefixes):
+            tables[t]["hidden"] = True
 
     return tables
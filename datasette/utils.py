@@ -7,10 +7,12 @@ import imp
 import json
 import os
 import pkg_resources
+import queue
 import re
 import shlex
 import tempfile
 import time
+import threading
 import shutil
 import urllib
 import numbers
@@ -20,6 +22,9 @@ try:
 except ImportError:
     import sqlite3
 
+# Table-valued pragma functions such as pragma_table_info() need SQLite 3.16
+SQLITE_TABLE_VALUED_PRAGMAS = sqlite3.sqlite_version_info >= (3, 16, 0)
+
 # From https://www.sqlite.org/lang_keywords.html
 reserved_words = set((
     'abort action add after all alter analyze and as asc attach autoincrement '
@@ -48,6 +53,18 @@ class InterruptedError(Exception):
     pass
 
 
+def decode_utf8_replace(b):
+    "Lenient text_factory for databases containing invalid UTF-8"
+    return str(b, "utf-8", "replace")
+
+
+def is_utf8_decode_error(e):
+    return (
+        isinstance(e, sqlite3.OperationalError)
+        and str(e).startswith("Could not decode to UTF-8")
+    )
+
+
 class Results:
     def __init__(self, rows, truncated, description):
         self.rows = rows
@@ -136,6 +153,46 @@ class CustomJSONEncoder(json.JSONEncoder):
         return json.JSONEncoder.default(self, obj)
 
 
+class ConnectionPool:
+    """ Bounded pool of connections created on demand by calling connect()
+
+        Callers block waiting for a connection to be released once
+        max_size connections are in use.
+    """
+    def __init__(self, connect, max_size):
+        self.connect = connect
+        self.max_size = max_size
+        self.size = 0
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def connection(self):
+        conn = self._acquire()
+        try:
+            yield conn
+        finally:
+            self._idle.put(conn)
+
+    def _acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            should_connect = self.size < self.max_size
+            if should_connect:
+                self.size += 1
+        if not should_connect:
+            return self._idle.get()
+        try:
+            return self.connect()
+        except Exception:
+            with self._lock:
+                self.size -= 1
+            raise
+
+
 @contextmanager
 def sqlite_timelimit(conn, ms):
     deadline = time.time() + (ms / 1000)
@@ -152,8 +209,11 @@ def sqlite_timelimit(conn, ms):
             return 1
 
     conn.set_progress_handler(handler, n)
-    yield
-    conn.set_progress_handler(None, n)
+    try:
+        yield
+    finally:
+        # Pooled connections are reused, so never leave an expired handler
+        conn.set_progress_handler(None, n)
 
 
 class InvalidSql(Exception):
@@ -478,9 +538,14 @@ def get_all_foreign_keys(conn):
             'outgoing': [],
         }
     for table in tables:
-        infos = conn.execute(
-            'PRAGMA foreign_key_list([{}])'.format(table)
-        ).fetchall()
+        if SQLITE_TABLE_VALUED_PRAGMAS:
+            infos = conn.execute(
+                'select * from pragma_foreign_key_list(?)', [table]
+            ).fetchall()
+        else:
+            infos = conn.execute(
+                'PRAGMA foreign_key_list("{}")'.format(table.replace('"', '""'))
+            ).fetchall()
         for info in infos:
             if info is not None:
                 id, seq, table_name, from_, to_, on_update, on_delete, match = info
@@ -502,11 +567,6 @@ def get_all_foreign_keys(conn):
     return table_to_foreign_keys
 
 
-def detect_spatialite(conn):
-    rows = conn.execute('select 1 from sqlite_master where tbl_name = "geometry_columns"').fetchall()
-    return len(rows) > 0
-
-
 def detect_fts(conn, table):
     "Detect if table has a corresponding FTS virtual table and return it"
     rows = conn.execute(detect_fts_sql(table)).fetchall()
@@ -847,6 +907,29 @@ class CustomRow(OrderedDict):
             yield self[column]
 
 
+class LRUCache:
+    "Dictionary-style cache that evicts the least recently used items"
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._items = OrderedDict()
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def __getitem__(self, key):
+        self._items.move_to_end(key)
+        return self._items[key]
+
+    def __setitem__(self, key, value):
+        self._items[key] = value
+        self._items.move_to_end(key)
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+
+    def __len__(self):
+        return len(self._items)
+
+
 def value_as_boolean(value):
     if value.lower() not in ('on', 'off', 'true', 'false', '1', '0'):
         raise ValueAsBooleanError
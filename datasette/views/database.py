@@ -20,7 +20,10 @@ class DatabaseView(BaseView):
         info = self.ds.inspect()[database]
         metadata = (self.ds.metadata("databases") or {}).get(database, {})
         self.ds.update_with_inherited_metadata(metadata)
-        tables = list(info["tables"].values())
+        counts = await self.ds.table_counts(database)
+        tables = [
+            dict(t, count=counts[t["name"]]) for t in info["tables"].values()
+        ]
         tables.sort(key=lambda t: (t["hidden"], t["name"]))
         return {
             "database": database,
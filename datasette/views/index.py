@@ -16,21 +16,45 @@ class IndexView(RenderMixin):
     async def get(self, request, as_format):
         databases = []
         for key, info in sorted(self.ds.inspect().items()):
-            tables = [t for t in info["tables"].values() if not t["hidden"]]
-            hidden_tables = [t for t in info["tables"].values() if t["hidden"]]
+            counts = await self.ds.table_counts(key, use_estimated_count=True)
+            estimated_counts = await self.ds.estimated_table_counts(key)
+            all_tables = [
+                dict(
+                    t,
+                    count=counts[t["name"]],
+                    count_estimated=(
+                        counts[t["name"]] is not None
+                        and counts[t["name"]] == estimated_counts.get(t["name"])
+                        and t["count"] is None
+                    ),
+                )
+                for t in info["tables"].values()
+            ]
+            tables = [t for t in all_tables if not t["hidden"]]
+            hidden_tables = [t for t in all_tables if t["hidden"]]
             database = {
                 "name": key,
                 "hash": info["hash"],
                 "path": "{}-{}".format(key, info["hash"][:HASH_LENGTH]),
                 "tables_truncated": sorted(
-                    tables, key=lambda t: t["count"], reverse=True
+                    tables, key=lambda t: t["count"] or 0, reverse=True
                 )[
                     :5
                 ],
                 "tables_count": len(tables),
                 "tables_more": len(tables) > 5,
-                "table_rows_sum": sum(t["count"] for t in tables),
-                "hidden_table_rows_sum": sum(t["count"] for t in hidden_tables),
+                "table_rows_sum": sum(t["count"] or 0 for t in tables),
+                # True if the sum includes estimated or uncounted tables
+                "table_rows_sum_estimated": any(
+                    t["count_estimated"] or t["count"] is None for t in tables
+                ),
+                "hidden_table_rows_sum": sum(
+                    t["count"] or 0 for t in hidden_tables
+                ),
+                "hidden_table_rows_sum_estimated": any(
+                    t["count_estimated"] or t["count"] is None
+                    for t in hidden_tables
+                ),
                 "hidden_tables_count": len(hidden_tables),
                 "views_count": len(info["views"]),
             }
@@ -28,6 +28,9 @@ from .base import BaseView, DatasetteError, ureg
 LINK_WITH_LABEL = '<a href="/{database}/{table}/{link_id}">{label}</a>&nbsp;<em>{id}</em>'
 LINK_WITH_VALUE = '<a href="/{database}/{table}/{link_id}">{id}</a>'
 
+# Default SQLITE_MAX_VARIABLE_NUMBER for SQLite versions prior to 3.32.0
+SQLITE_MAX_VARIABLES = 999
+
 
 class RowTableShared(BaseView):
 
@@ -36,7 +39,7 @@ class RowTableShared(BaseView):
         if "sortable_columns" in table_metadata:
             sortable_columns = set(table_metadata["sortable_columns"])
         else:
-            table_info = self.ds.inspect()[database]["tables"].get(table) or {}
+            table_info = self.ds.get_table_info(database, table)
             sortable_columns = set(table_info.get("columns", []))
         if use_rowid:
             sortable_columns.add("rowid")
@@ -44,8 +47,7 @@ class RowTableShared(BaseView):
 
     def expandable_columns(self, database, table):
         # Returns list of (fk_dict, label_column-or-None) pairs for that table
-        tables = self.ds.inspect()[database].get("tables", {})
-        table_info = tables.get(table)
+        table_info = self.ds.get_table_info(database, table)
         if not table_info:
             return []
         expandables = []
@@ -54,59 +56,99 @@ class RowTableShared(BaseView):
                 self.table_metadata(
                     database, fk["other_table"]
                 ).get("label_column")
-                or tables.get(fk["other_table"], {}).get("label_column")
+                or self.ds.get_table_info(
+                    database, fk["other_table"]
+                ).get("label_column")
             ) or None
             expandables.append((fk, label_column))
         return expandables
 
     async def expand_foreign_keys(self, database, table, column, values):
         "Returns dict mapping (column, value) -> label"
-        labeled_fks = {}
-        tables_info = self.ds.inspect()[database]["tables"]
-        table_info = tables_info.get(table) or {}
+        return await self.expand_foreign_keys_for_columns(
+            database, table, {column: set(values)}
+        )
+
+    async def expand_foreign_keys_for_columns(self, database, table, column_values):
+        """ Returns dict mapping (column, value) -> label for a dictionary
+            of column -> set of values, looking up every label in one query
+        """
+        table_info = self.ds.get_table_info(database, table)
         if not table_info:
             return {}
-        foreign_keys = table_info["foreign_keys"]["outgoing"]
-        # Find the foreign_key for this column
-        try:
-            fk = [
-                foreign_key for foreign_key in foreign_keys
-                if foreign_key["column"] == column
-            ][0]
-        except IndexError:
-            return {}
-        label_column = (
-            # First look in metadata.json for this foreign key table:
-            self.table_metadata(
-                database, fk["other_table"]
-            ).get("label_column")
-            or tables_info.get(fk["other_table"], {}).get("label_column")
-        )
-        if not label_column:
-            return {
-                (fk["column"], value): str(value)
-                for value in values
-            }
+        foreign_keys = {}
+        for foreign_key in table_info["foreign_keys"]["outgoing"]:
+            foreign_keys.setdefault(foreign_key["column"], foreign_key)
         labeled_fks = {}
-        sql = '''
-            select {other_column}, {label_column}
-            from {other_table}
-            where {other_column} in ({placeholders})
-        '''.format(
-            other_column=escape_sqlite(fk["other_column"]),
-            label_column=escape_sqlite(label_column),
-            other_table=escape_sqlite(fk["other_table"]),
-            placeholders=", ".join(["?"] * len(set(values))),
-        )
-        try:
-            results = await self.ds.execute(
-                database, sql, list(set(values))
+        label_cache = self.ds.foreign_key_label_cache
+        selects = []
+        select_cache_keys = []
+        for column, values in column_values.items():
+            fk = foreign_keys.get(column)
+            if fk is None:
+                continue
+            label_column = (
+                # First look in metadata.json for this foreign key table:
+                self.table_metadata(
+                    database, fk["other_table"]
+                ).get("label_column")
+                or self.ds.get_table_info(
+                    database, fk["other_table"]
+                ).get("label_column")
             )
+            if not label_column:
+                labeled_fks.update({
+                    (fk["column"], value): str(value)
+                    for value in values
+                })
+                continue
+            # Labels are cached - the databases are immutable
+            cache_key = (
+                database, fk["other_table"], fk["other_column"], label_column
+            )
+            ids = []
+            for id in values:
+                if cache_key + (id,) in label_cache:
+                    label = label_cache[cache_key + (id,)]
+                    labeled_fks[(fk["column"], id)] = label
+                else:
+                    ids.append(id)
+            if not ids:
+                continue
+            for i in range(0, len(ids), SQLITE_MAX_VARIABLES):
+                chunk = ids[i:i + SQLITE_MAX_VARIABLES]
+                selects.append(('''
+                    select {index}, {other_column}, {label_column}
+                    from {other_table}
+                    where {other_column} in ({placeholders})
+                '''.format(
+                    index=len(selects),
+                    other_column=escape_sqlite(fk["other_column"]),
+                    label_column=escape_sqlite(label_column),
+                    other_table=escape_sqlite(fk["other_table"]),
+                    placeholders=", ".join(["?"] * len(chunk)),
+                ), chunk))
+                select_cache_keys.append((fk["column"], cache_key))
+        if not selects:
+            return labeled_fks
+        if sum(len(chunk) for sql, chunk in selects) <= SQLITE_MAX_VARIABLES:
+            queries = [(
+                " union all ".join(sql for sql, chunk in selects),
+                [id for sql, chunk in selects for id in chunk],
+            )]
+        else:
+            # Too many parameters for a single statement - run the selects
+            # one after another in a single trip to a SQL thread instead
+            queries = selects
+        try:
+            results = await self.ds.execute_many(database, queries)
         except InterruptedError:
             pass
         else:
-            for id, value in results:
-                labeled_fks[(fk["column"], id)] = value
+            for index, id, value in results:
+                column, cache_key = select_cache_keys[index]
+                labeled_fks[(column, id)] = value
+                label_cache[cache_key + (id,)] = value
         return labeled_fks
 
     async def display_columns_and_rows(
@@ -120,13 +162,11 @@ class RowTableShared(BaseView):
     ):
         "Returns columns, rows for specified table - including fancy foreign key treatment"
         table_metadata = self.table_metadata(database, table)
-        info = self.ds.inspect()[database]
         sortable_columns = self.sortable_columns_for_table(database, table, True)
         columns = [
             {"name": r[0], "sortable": r[0] in sortable_columns} for r in description
         ]
-        tables = info["tables"]
-        table_info = tables.get(table) or {}
+        table_info = self.ds.get_table_info(database, table)
         pks = table_info.get("primary_keys") or []
         column_to_foreign_key_table = {
             fk["column"]: fk["other_table"]
@@ -246,9 +286,11 @@ class TableView(RowTableShared):
                 canned_query=table,
             )
 
-        is_view = bool(await self.ds.get_view_definition(database, table))
-        info = self.ds.inspect()
-        table_info = info[database]["tables"].get(table) or {}
+        definition_type, definition_sql = await self.ds.get_definition(
+            database, table
+        )
+        is_view = definition_type == "view"
+        table_info = self.ds.get_table_info(database, table)
         if not is_view and not table_info:
             raise NotFound("Table not found: {}".format(table))
 
@@ -316,7 +358,7 @@ class TableView(RowTableShared):
 
         # _search support:
         fts_table = table_metadata.get(
-            "fts_table", info[database]["tables"].get(table, {}).get("fts_table")
+            "fts_table", table_info.get("fts_table")
         )
         fts_pk = table_metadata.get("fts_pk", "rowid")
         search_args = dict(
@@ -338,7 +380,9 @@ class TableView(RowTableShared):
                 params["search"] = search
             else:
                 # More complex: search against specific columns
-                valid_columns = set(info[database]["tables"][fts_table]["columns"])
+                valid_columns = set(
+                    self.ds.get_table_info(database, fts_table).get("columns", [])
+                )
                 for i, (key, search_text) in enumerate(search_args.items()):
                     search_col = key.split("_search_", 1)[1]
                     if search_col not in valid_columns:
@@ -361,7 +405,7 @@ class TableView(RowTableShared):
         table_rows_count = None
         sortable_columns = set()
         if not is_view:
-            table_rows_count = table_info["count"]
+            table_rows_count = await self.ds.table_count(database, table)
 
         sortable_columns = self.sortable_columns_for_table(database, table, use_rowid)
 
@@ -609,7 +653,7 @@ class TableView(RowTableShared):
             ]
 
         if columns_to_expand:
-            expanded_labels = {}
+            column_values = {}
             for fk, label_column in expandable_columns:
                 column = fk["column"]
                 if column not in columns_to_expand:
@@ -617,11 +661,11 @@ class TableView(RowTableShared):
                 expanded_columns.append(column)
                 # Gather the values
                 column_index = columns.index(column)
-                values = [row[column_index] for row in rows]
-                # Expand them
-                expanded_labels.update(await self.expand_foreign_keys(
-                    database, table, column, values
-                ))
+                column_values[column] = {row[column_index] for row in rows}
+            # Expand them all at once
+            expanded_labels = await self.expand_foreign_keys_for_columns(
+                database, table, column_values
+            )
             if expanded_labels:
                 # Rewrite the rows
                 new_rows = []
@@ -670,13 +714,17 @@ class TableView(RowTableShared):
         # Number of filtered rows in whole set:
         filtered_table_rows_count = None
         if count_sql:
-            try:
-                count_rows = list(await self.ds.execute(
-                    database, count_sql, from_sql_params
-                ))
-                filtered_table_rows_count = count_rows[0][0]
-            except InterruptedError:
-                pass
+            if not from_sql_where_clauses and table_rows_count is not None:
+                # Unfiltered, so count_sql would just count the table again
+                filtered_table_rows_count = table_rows_count
+            else:
+                try:
+                    count_rows = (await self.ds.execute(
+                        database, count_sql, from_sql_params
+                    )).rows
+                    filtered_table_rows_count = count_rows[0][0]
+                except InterruptedError:
+                    pass
 
             # Detect suggested facets
             suggested_facets = []
@@ -783,8 +831,10 @@ class TableView(RowTableShared):
                     "_rows_and_columns.html",
                 ],
                 "metadata": metadata,
-                "view_definition": await self.ds.get_view_definition(database, table),
-                "table_definition": await self.ds.get_table_definition(database, table),
+                "view_definition": definition_sql if is_view else None,
+                "table_definition": (
+                    definition_sql if definition_type == "table" else None
+                ),
             }
 
         return {
@@ -816,8 +866,7 @@ class RowView(RowTableShared):
 
     async def data(self, request, database, hash, table, pk_path, default_labels=False):
         pk_values = urlsafe_components(pk_path)
-        info = self.ds.inspect()[database]
-        table_info = info["tables"].get(table) or {}
+        table_info = self.ds.get_table_info(database, table)
         pks = table_info.get("primary_keys") or []
         use_rowid = not pks
         select = "*"
@@ -898,7 +947,7 @@ class RowView(RowTableShared):
         if len(pk_values) != 1:
             return []
 
-        table_info = self.ds.inspect()[database]["tables"].get(table)
+        table_info = self.ds.get_table_info(database, table)
         if not table_info:
             return []
 
@@ -916,7 +965,9 @@ class RowView(RowTableShared):
             ]
         )
         try:
-            rows = list(await self.ds.execute(database, sql, {"id": pk_values[0]}))
+            rows = (
+                await self.ds.execute(database, sql, {"id": pk_values[0]})
+            ).rows
         except sqlite3.OperationalError:
             # Almost certainly hit the timeout
             return []
@@ -185,6 +185,7 @@ METADATA = {
             },
             'queries': {
                 'pragma_cache_size': 'PRAGMA cache_size;',
+                'pragma_mmap_size': 'PRAGMA mmap_size;',
                 'neighborhood_search': {
                     'sql': '''
                         select neighborhood, facet_cities.name, state
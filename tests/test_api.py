@@ -8,7 +8,11 @@ from .fixtures import ( # noqa
     generate_sortable_rows,
     METADATA,
 )
+from datasette.app import Datasette
+from datasette.utils import sqlite3
+import os
 import pytest
+import tempfile
 import urllib
 
 
@@ -984,6 +988,20 @@ def test_versions_json(app_client):
     assert 'fts_versions' in response.json['sqlite']
 
 
+def test_invalid_utf8_text_is_replaced():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filepath = os.path.join(tmpdir, 'invalid_utf8.db')
+        conn = sqlite3.connect(filepath)
+        conn.execute('create table t (content text)')
+        conn.execute("insert into t values (cast(x'ff41' as text))")
+        conn.commit()
+        client = Datasette([filepath]).app().test_client
+        response = client.get(
+            '/invalid_utf8/t.json?_shape=array', gather_request=False
+        )
+        assert [{'rowid': 1, 'content': '\ufffdA'}] == response.json
+
+
 def test_config_json(app_client):
     response = app_client.get(
         "/-/config.json"
@@ -1002,6 +1020,7 @@ def test_config_json(app_client):
         "default_cache_ttl": 365 * 24 * 60 * 60,
         "num_sql_threads": 3,
         "cache_size_kb": 0,
+        "mmap_size_mb": 256,
         "allow_csv_stream": True,
         "max_csv_mb": 100,
         "truncate_cells_html": 2048,
@@ -1249,6 +1268,45 @@ def test_expand_label(app_client):
     } == response.json
 
 
+def test_expand_labels_multiple_foreign_keys(app_client):
+    response = app_client.get(
+        "/fixtures/complex_foreign_keys.json?_shape=object&_labels=on"
+    )
+    assert {
+        "1": {
+            "pk": "1",
+            "f1": {"value": "1", "label": "hello"},
+            "f2": {"value": "2", "label": "world"},
+            "f3": {"value": "1", "label": "hello"},
+        }
+    } == response.json
+
+
+def test_expand_labels_too_many_parameters(app_client, monkeypatch):
+    from datasette.utils import LRUCache
+    from datasette.views import table
+    monkeypatch.setattr(table, 'SQLITE_MAX_VARIABLES', 1)
+    monkeypatch.setattr(app_client.ds, 'foreign_key_label_cache', LRUCache(10))
+    execute_many = app_client.ds.execute_many
+    executed = []
+
+    async def recording_execute_many(db_name, queries, **kwargs):
+        executed.extend(queries)
+        return await execute_many(db_name, queries, **kwargs)
+
+    monkeypatch.setattr(app_client.ds, 'execute_many', recording_execute_many)
+    response = app_client.get(
+        "/fixtures/complex_foreign_keys.json?_shape=object&_labels=on"
+    )
+    # One select per foreign key column, each with a single parameter
+    assert 3 == len(executed)
+    assert {
+        "f1": {"value": "1", "label": "hello"},
+        "f2": {"value": "2", "label": "world"},
+        "f3": {"value": "1", "label": "hello"},
+    }.items() <= response.json["1"].items()
+
+
 @pytest.mark.parametrize('path,expected_cache_control', [
     ("/fixtures/facetable.json", "max-age=31536000"),
     ("/fixtures/facetable.json?_ttl=invalid", "max-age=31536000"),
@@ -1303,6 +1361,11 @@ def test_config_cache_size(app_client_larger_cache_size):
     assert [[-2500]] == response.json['rows']
 
 
+def test_config_mmap_size(app_client):
+    response = app_client.get('/fixtures/pragma_mmap_size.json')
+    assert [[256 * 1024 * 1024]] == response.json['rows']
+
+
 def test_config_force_https_urls():
     for client in app_client(config={"force_https_urls": True}):
         response = client.get("/fixtures/facetable.json?_size=3&_facet=state")
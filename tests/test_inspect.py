@@ -1,5 +1,13 @@
 from datasette.app import Datasette
-from datasette.utils import sqlite3
+from datasette.inspect import (
+    inspect_columns,
+    inspect_estimated_counts,
+    inspect_sqlite_master,
+    inspect_tables,
+    inspect_views,
+)
+from datasette.utils import InterruptedError, get_all_foreign_keys, sqlite3
+import asyncio
 import os
 import pytest
 import tempfile
@@ -44,6 +52,13 @@ def ds_instance():
         yield Datasette([filepath])
 
 
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
+
+
 def test_inspect_hidden_tables(ds_instance):
     info = ds_instance.inspect()
     tables = info['fixtures']['tables']
@@ -73,7 +88,7 @@ def test_inspect_foreign_keys(ds_instance):
     info = ds_instance.inspect()
     tables = info['fixtures']['tables']
     for table_name in ('county', 'party', 'office'):
-        assert 0 == tables[table_name]['count']
+        assert None is tables[table_name]['count']
         foreign_keys = tables[table_name]['foreign_keys']
         assert [] == foreign_keys['outgoing']
         assert [{
@@ -83,7 +98,7 @@ def test_inspect_foreign_keys(ds_instance):
         }] == foreign_keys['incoming']
 
     election_results = tables['election_results']
-    assert 0 == election_results['count']
+    assert None is election_results['count']
     assert sorted([{
         'column': 'county',
         'other_column': 'id',
@@ -101,3 +116,198 @@ def test_inspect_foreign_keys(ds_instance):
         key=lambda d: d['column']
     )
     assert [] == election_results['foreign_keys']['incoming']
+
+
+def test_foreign_keys_without_table_valued_pragmas(monkeypatch):
+    conn = sqlite3.connect(':memory:')
+    conn.executescript(TABLES)
+    expected = get_all_foreign_keys(conn)
+    assert expected['election_results']['outgoing']
+    monkeypatch.setattr('datasette.utils.SQLITE_TABLE_VALUED_PRAGMAS', False)
+    assert expected == get_all_foreign_keys(conn)
+
+
+def test_inspect_columns_and_primary_keys(ds_instance):
+    tables = ds_instance.inspect()['fixtures']['tables']
+    assert ['id', 'name'] == tables['county']['columns']
+    assert ['id'] == tables['county']['primary_keys']
+    assert 'name' == tables['county']['label_column']
+    assert [
+        'county', 'party', 'office', 'votes'
+    ] == tables['election_results']['columns']
+    assert [] == tables['election_results']['primary_keys']
+
+
+def test_inspect_counts(ds_instance, loop):
+    counts = loop.run_until_complete(ds_instance.table_counts('fixtures'))
+    assert {
+        'election_results': 0,
+        'county': 0,
+        'party': 0,
+        'office': 0,
+    }.items() <= counts.items()
+
+
+@pytest.fixture
+def analyzed_db_path():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filepath = os.path.join(tmpdir, 'analyzed.db')
+        conn = sqlite3.connect(filepath)
+        conn.executescript('''
+            CREATE TABLE analyzed (id INTEGER PRIMARY KEY, name TEXT);
+            CREATE INDEX analyzed_name ON analyzed (name);
+            CREATE TABLE not_analyzed (id INTEGER PRIMARY KEY);
+            INSERT INTO analyzed (name) VALUES ('a'), ('b'), ('c');
+            INSERT INTO not_analyzed VALUES (1), (2);
+            ANALYZE analyzed;
+        ''')
+        # Make the estimate distinguishable from an exact count
+        conn.execute("UPDATE sqlite_stat1 SET stat = '1000 1' WHERE tbl = 'analyzed'")
+        conn.commit()
+        conn.close()
+        yield filepath
+
+
+def test_inspect_estimated_counts(analyzed_db_path):
+    conn = sqlite3.connect(':memory:')
+    # No sqlite_stat1 table, ANALYZE has never been run
+    assert {} == inspect_estimated_counts(conn)
+    conn = sqlite3.connect(analyzed_db_path)
+    assert {'analyzed': 1000} == inspect_estimated_counts(conn)
+    # A partial index covers fewer rows than its table
+    conn = sqlite3.connect(':memory:')
+    conn.executescript('''
+        CREATE TABLE t (a INTEGER, b INTEGER);
+        CREATE INDEX za ON t (a);
+        CREATE INDEX zb ON t (b) WHERE b = 1;
+    ''')
+    conn.executemany(
+        'INSERT INTO t VALUES (?, ?)', [(i, i % 300) for i in range(1000)]
+    )
+    conn.execute('ANALYZE')
+    assert {'t': 1000} == inspect_estimated_counts(conn)
+
+
+def test_table_counts_use_estimated_count(analyzed_db_path, loop):
+    ds = Datasette([analyzed_db_path])
+    assert {'analyzed': 3, 'not_analyzed': 2}.items() <= loop.run_until_complete(
+        ds.table_counts('analyzed')
+    ).items()
+    ds = Datasette([analyzed_db_path])
+    assert {'analyzed': 1000, 'not_analyzed': 2}.items() <= loop.run_until_complete(
+        ds.table_counts('analyzed', use_estimated_count=True)
+    ).items()
+
+
+def test_estimated_counts_after_interrupted_query(analyzed_db_path, loop):
+    # One SQL thread, so both queries use the same pooled connection
+    ds = Datasette([analyzed_db_path], config={'num_sql_threads': 1})
+    with pytest.raises(InterruptedError):
+        loop.run_until_complete(ds.execute(
+            'analyzed',
+            'with recursive c(x) as (select 1 union all select x + 1 from c) '
+            'select count(*) from c',
+            custom_time_limit=20,
+        ))
+    assert {'analyzed': 1000} == loop.run_until_complete(
+        ds.estimated_table_counts('analyzed')
+    )
+
+
+def test_table_count_caches_timeouts(analyzed_db_path, loop, monkeypatch):
+    calls = []
+
+    def interrupted_count(conn, table):
+        calls.append(table)
+        raise InterruptedError('interrupted')
+
+    monkeypatch.setattr('datasette.app.inspect_count', interrupted_count)
+    ds = Datasette([analyzed_db_path])
+    for _ in range(2):
+        assert None is loop.run_until_complete(
+            ds.table_count('analyzed', 'not_analyzed')
+        )
+    assert ['not_analyzed'] == calls
+
+
+def test_inspect_counts_after_inspect_without_counts(analyzed_db_path):
+    ds = Datasette([analyzed_db_path])
+    assert None is ds.inspect()['analyzed']['tables']['analyzed']['count']
+    assert 3 == ds.inspect(counts=True)['analyzed']['tables']['analyzed']['count']
+
+
+def test_inspect_schema_version(ds_instance):
+    info = ds_instance.inspect()['fixtures']
+    conn = sqlite3.connect(info['file'])
+    expected = conn.execute('PRAGMA schema_version').fetchone()[0]
+    assert expected == info['schema_version']
+
+
+def test_inspect_columns_compound_primary_key():
+    conn = sqlite3.connect(':memory:')
+    conn.executescript('''
+        CREATE TABLE "compound ]pk" (
+          b TEXT, a TEXT, c TEXT, PRIMARY KEY (a, b)
+        );
+    ''')
+    assert (
+        ['b', 'a', 'c'], ['a', 'b']
+    ) == inspect_columns(conn)['compound ]pk']
+
+
+def test_inspect_columns_without_table_valued_pragmas(monkeypatch):
+    conn = sqlite3.connect(':memory:')
+    conn.executescript(TABLES + '''
+        CREATE TABLE "compound ]pk" (
+          b TEXT, a TEXT, c TEXT, PRIMARY KEY (a, b)
+        );
+    ''')
+    expected = inspect_columns(conn)
+    monkeypatch.setattr('datasette.inspect.SQLITE_TABLE_VALUED_PRAGMAS', False)
+    assert expected == inspect_columns(conn)
+
+
+def test_inspect_hides_spatialite_tables():
+    conn = sqlite3.connect(':memory:')
+    conn.executescript('''
+        CREATE TABLE geometry_columns (f_table_name TEXT);
+        CREATE TABLE spatial_ref_sys (srid INTEGER);
+        CREATE TABLE idx_museums_point_geom (pkid INTEGER);
+        CREATE TABLE museums (id INTEGER PRIMARY KEY, name TEXT);
+        CREATE VIEW museum_names AS SELECT name FROM museums;
+    ''')
+    sqlite_master = inspect_sqlite_master(conn)
+    assert ['museum_names'] == inspect_views(sqlite_master)
+    tables = inspect_tables(conn, {}, sqlite_master)
+    assert ['museums'] == [
+        name for name, table in tables.items() if not table['hidden']
+    ]
+
+
+def test_inspect_data_is_refreshed_if_schema_changed(ds_instance):
+    info = ds_instance.inspect()['fixtures']
+    # Unchanged schema: the provided inspect data is used as-is
+    current = dict(info, tables={})
+    ds = Datasette([], inspect_data={'fixtures': current})
+    assert {} == ds.inspect()['fixtures']['tables']
+    # Changed schema: that database is inspected again
+    stale = dict(info, tables={}, schema_version=info['schema_version'] - 1)
+    ds = Datasette([], inspect_data={'fixtures': stale})
+    assert info['tables'].keys() == ds.inspect()['fixtures']['tables'].keys()
+    assert info['schema_version'] == ds.inspect()['fixtures']['schema_version']
+
+
+def test_inspect_invalid_utf8_schema():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filepath = os.path.join(tmpdir, 'invalid_utf8.db')
+        conn = sqlite3.connect(filepath)
+        conn.execute('CREATE TABLE "bad_XX" (id INTEGER PRIMARY KEY)')
+        conn.commit()
+        conn.close()
+        # Same length replacement keeps the sqlite_master record valid
+        with open(filepath, 'rb') as fp:
+            data = fp.read()
+        with open(filepath, 'wb') as fp:
+            fp.write(data.replace(b'bad_XX', b'bad_\xff\xfe'))
+        ds = Datasette([filepath])
+        assert ['bad_\ufffd\ufffd'] == list(ds.inspect()['invalid_utf8']['tables'])
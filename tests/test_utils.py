@@ -374,3 +374,45 @@ def test_path_with_format(path, format, extra_qs, expected):
     )
     actual = utils.path_with_format(request, format, extra_qs)
     assert expected == actual
+
+
+def test_connection_pool():
+    pool = utils.ConnectionPool(
+        lambda: utils.sqlite3.connect(':memory:'), max_size=2
+    )
+    with pool.connection() as conn1:
+        with pool.connection() as conn2:
+            assert conn1 is not conn2
+            assert 2 == pool.size
+    # Released connections are reused rather than opening new ones
+    with pool.connection() as conn3:
+        assert conn3 in (conn1, conn2)
+    assert 2 == pool.size
+
+
+def test_lru_cache():
+    cache = utils.LRUCache(max_size=2)
+    cache['a'] = 1
+    cache['b'] = 2
+    # Reading 'a' makes 'b' the least recently used item
+    assert 1 == cache['a']
+    cache['c'] = 3
+    assert 'a' in cache
+    assert 'b' not in cache
+    assert 'c' in cache
+    assert 2 == len(cache)
+
+
+def test_sqlite_timelimit_removes_handler_after_interrupt():
+    conn = utils.sqlite3.connect(':memory:')
+    counter_sql = (
+        'with recursive c(x) as (select 1 union all select x + 1 from c{}) '
+        'select count(*) from c'
+    )
+    with pytest.raises(utils.sqlite3.OperationalError):
+        with utils.sqlite_timelimit(conn, 1):
+            conn.execute(counter_sql.format('')).fetchall()
+    # The expired progress handler must not interrupt later queries
+    assert [(100000,)] == conn.execute(
+        counter_sql.format(' limit 100000')
+    ).fetchall()